@@ -8,15 +8,25 @@ including ext4, NTFS, or macOS HFS/APFS.
 Also provides optional helpers for generating full paths under a per-repo directory.
 """
 
+import functools
 import urllib.parse
 import os
 
+# Precomputed byte -> encoded-string table for safe_refname_to_filename.
+# Matches what urllib.parse.quote produced before: alphanumerics plus
+# '-', '_', '.', '~' pass through, every other byte becomes %XX.
+_SAFE_BYTES = frozenset(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_.~"
+)
+_ENCODE_TABLE = [chr(b) if b in _SAFE_BYTES else "%{:02X}".format(b) for b in range(256)]
+
+@functools.lru_cache(maxsize=None)
 def safe_refname_to_filename(ref_name: str) -> str:
     """
     Encode a Git ref name into a filesystem-safe filename.
     All characters except alphanumerics, '-', '_', and '.' are percent-encoded.
     """
-    return urllib.parse.quote(ref_name, safe='A-Za-z0-9-_.') + ".txt"
+    return "".join(_ENCODE_TABLE[b] for b in ref_name.encode("utf-8")) + ".txt"
 
 def filename_to_refname(filename: str) -> str:
     """
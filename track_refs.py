@@ -24,12 +24,20 @@ Features:
  Exports commits for all branches and tags into per-repo directories in tracking branch
 """
 
+import hashlib
 import os
 import subprocess
 import sys
 import json
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+
+try:
+    import orjson  # optional, much faster JSON serialization
+except ImportError:
+    orjson = None
 from refname_utils import branch_file_path, tag_file_path, safe_refname_to_filename, filename_to_refname
 
 # Paths
@@ -37,6 +45,7 @@ TRACKING_WORKTREE_DIR = "../zimbra-tracker-tracking"
 REPO_LIST_FILE = "zimbra_tracked_repos.txt"
 REPOS_DIR = os.path.join(TRACKING_WORKTREE_DIR, "repos")
 TMP_REPOS_DIR = "tmp_repos"  # temporary clone location (ignored by git)
+TIPS_CACHE_DIR = os.path.join(TRACKING_WORKTREE_DIR, ".tips")  # ls-remote digests per repo
 
 def run(cmd, cwd=None, capture=True):
     """Run a command and return stdout"""
@@ -46,6 +55,24 @@ def run(cmd, cwd=None, capture=True):
         sys.exit(1)
     return result.stdout.strip() if capture else None
 
+def run_stream(cmd, cwd=None):
+    """Run a command and yield stdout lines without buffering the whole output"""
+    proc = subprocess.Popen(cmd, cwd=cwd, text=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Drain stderr concurrently; a child emitting lots of warnings would
+    # otherwise fill the pipe and deadlock against our stdout reads.
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()))
+    stderr_reader.start()
+    for line in proc.stdout:
+        yield line.rstrip("\n")
+    proc.stdout.close()
+    stderr_reader.join()
+    proc.stderr.close()
+    if proc.wait() != 0:
+        print(f"Command failed: {' '.join(cmd)}\n{''.join(stderr_chunks)}")
+        sys.exit(1)
+
 def ensure_tracking_worktree():
     """Create or reuse the tracking branch worktree."""
     # Save current branch name (if any)
@@ -97,101 +124,248 @@ def ensure_repo_cloned(repo_id, clone_url):
     path = os.path.join(TMP_REPOS_DIR, repo_id)
     if not os.path.exists(path):
         print(f"Cloning {repo_id}...")
-        subprocess.run(["git", "clone", "--mirror", clone_url, path], check=True)
+        # Blobless partial clone: the exports only read commit metadata, so
+        # file contents never need to be transferred or stored.
+        subprocess.run(["git", "clone", "--mirror", "--filter=blob:none", clone_url, path], check=True)
     else:
         print(f"Fetching updates for {repo_id}...")
-        subprocess.run(["git", "fetch", "--all"], cwd=path, check=True)
+        # The mirror refspec already covers every ref on origin; --all only
+        # added a pointless walk over (non-existent) extra remotes.
+        subprocess.run(["git", "fetch", "--prune", "origin"], cwd=path, check=True)
     return path
 
-def write_commit_list(filepath, commits):
-    """Write commits (list of strings) to file"""
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    with open(filepath, "w", encoding="utf-8") as f:
-        for line in commits:
-            f.write(line + "\n")
+def remote_tips_digest(clone_url):
+    """Digest the remote's advertised refs; an equal digest means nothing moved"""
+    output = run(["git", "ls-remote", clone_url])
+    return hashlib.sha256(output.encode("utf-8")).hexdigest()
+
+def read_cached_digest(repo_id):
+    """Return the ref digest stored by the previous run, if any"""
+    path = os.path.join(TIPS_CACHE_DIR, repo_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
 
-def export_branch_commits(repo_path, repo_id, branch_name, manifest):
-    """Export commits for a branch"""
-    commit_lines = run(["git", "log", "--reverse", "--pretty=format:%H %s", branch_name], cwd=repo_path).splitlines()
+def store_tips_digest(repo_id, digest):
+    """Record a repo's ref digest for the next run to compare against"""
+    os.makedirs(TIPS_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(TIPS_CACHE_DIR, repo_id), "w", encoding="utf-8") as f:
+        f.write(digest + "\n")
+
+def prepare_repo(repo_id, clone_url):
+    """Fetch a repo unless its remote refs are unchanged since the last snapshot"""
+    digest = remote_tips_digest(clone_url)
+    if digest == read_cached_digest(repo_id) and os.path.isdir(os.path.join(REPOS_DIR, repo_id)):
+        print(f"Remote {repo_id} unchanged, skipping")
+        return None, digest
+    return ensure_repo_cloned(repo_id, clone_url), digest
+
+def load_previous_all_tags():
+    """Read the previous snapshot's all-tags.json, used for skipped repos"""
+    path = os.path.join(TRACKING_WORKTREE_DIR, "all-tags.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_commit_list(filepath, commits, mode="w"):
+    """Write commits (list of strings) to file; the directory must exist"""
+    with open(filepath, mode, encoding="utf-8") as f:
+        if commits:
+            f.write("\n".join(commits) + "\n")
+
+def collect_commit_metadata(repo_path):
+    """Walk every ref once and map commit hash -> '<hash> <subject>' line"""
+    metadata = {}
+    for line in run_stream(["git", "log", "--all", "--pretty=format:%H %s"], cwd=repo_path):
+        metadata[line.split(" ", 1)[0]] = line
+    return metadata
+
+def collect_ref_tips(repo_path):
+    """Return ({branch: commit}, {tag: commit}) from one for-each-ref call"""
+    lines = run(["git", "for-each-ref",
+                 "--format=%(refname)%00%(refname:short)%00%(objectname)%00%(*objectname)",
+                 "refs/heads", "refs/tags"], cwd=repo_path).splitlines()
+    branch_tips = {}
+    tag_tips = {}
+    for line in lines:
+        refname, short_name, objectname, peeled = line.split("\x00")
+        # Annotated tags point at a tag object; the peeled field is the commit
+        tip = peeled or objectname
+        if refname.startswith("refs/heads/"):
+            branch_tips[short_name] = tip
+        else:
+            tag_tips[short_name] = tip
+    return branch_tips, tag_tips
+
+def last_exported_commit(file_path):
+    """Return the commit hash on the last line of an exported ref file, if any"""
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "rb") as f:
+        try:
+            f.seek(-4096, os.SEEK_END)
+        except OSError:
+            f.seek(0)
+        lines = f.read().splitlines()
+    if not lines:
+        return None
+    return lines[-1].split(b" ", 1)[0].decode("utf-8", "replace")
+
+def export_branch_commits(repo_path, repo_id, branch_name, tip, commit_metadata):
+    """Export commits for a branch and return its manifest entry"""
     file_path = branch_file_path(os.path.join(REPOS_DIR, repo_id), branch_name)
-    write_commit_list(file_path, commit_lines)
-    manifest[branch_name] = safe_refname_to_filename(branch_name)
-    print(f"Exported {len(commit_lines)} commits for branch {branch_name}")
-
-def export_tag_commit(repo_path, repo_id, tag_name, manifest, all_tags):
-    """Export commits for a tag and update global tag list"""
-    commit_line = run(["git", "log", "-1", "--pretty=format:%H %s", tag_name], cwd=repo_path)
-    commit_hash = commit_line.split(" ", 1)[0] if commit_line else ""
+    previous_tip = last_exported_commit(file_path)
+    if previous_tip == tip:
+        print(f"Branch {branch_name} unchanged, skipping export")
+        return branch_name, safe_refname_to_filename(branch_name)
+
+    # Append only the new range when the branch moved forward; fall back to a
+    # full export if the previous tip is gone or history was rewritten.
+    rev_range = branch_name
+    mode = "w"
+    if previous_tip:
+        ancestor = subprocess.run(["git", "merge-base", "--is-ancestor", previous_tip, branch_name],
+                                  cwd=repo_path, capture_output=True)
+        if ancestor.returncode == 0:
+            rev_range = f"{previous_tip}..{branch_name}"
+            mode = "a"
+
+    # Stream the walk straight into the file instead of materializing the
+    # full hash list and commit lines in memory first.
+    count = 0
+    with open(file_path, mode, encoding="utf-8", buffering=1 << 20) as f:
+        for commit_hash in run_stream(["git", "rev-list", "--reverse", rev_range], cwd=repo_path):
+            f.write(commit_metadata.get(commit_hash, commit_hash) + "\n")
+            count += 1
+    action = "Appended" if mode == "a" else "Exported"
+    print(f"{action} {count} commits for branch {branch_name}")
+    return branch_name, safe_refname_to_filename(branch_name)
+
+def export_tag_commit(repo_id, tag_name, tip, commit_metadata):
+    """Export the commit a tag points at and return its manifest entry"""
     file_path = tag_file_path(os.path.join(REPOS_DIR, repo_id), tag_name)
-    write_commit_list(file_path, [commit_line])
-    manifest[tag_name] = safe_refname_to_filename(tag_name)
-    all_tags[f"{repo_id}:{tag_name}"] = commit_hash
-    print(f"Exported commit for tag {tag_name}")
+    if last_exported_commit(file_path) != tip:
+        write_commit_list(file_path, [commit_metadata.get(tip, tip)])
+        print(f"Exported commit for tag {tag_name}")
+    return tag_name, safe_refname_to_filename(tag_name), tip
+
+def write_json(path, data):
+    """Serialize data as indented, key-sorted JSON (orjson when available)"""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+    else:
+        # ensure_ascii=False keeps the output byte-identical to the orjson
+        # path, so manifests don't get rewritten when the environment changes
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, sort_keys=True, ensure_ascii=False)
 
 def generate_manifest(manifest, repo_id, filename):
     """Write manifest JSON for a repo"""
     path = os.path.join(REPOS_DIR, repo_id, filename)
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(manifest, f, indent=2, sort_keys=True)
+    write_json(path, manifest)
     print(f"Generated {filename} for {repo_id}")
 
 def write_all_tags_manifest(all_tags):
     """Write the aggregated all-tags.json file at the root of tracking worktree"""
     path = os.path.join(TRACKING_WORKTREE_DIR, "all-tags.json")
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(all_tags, f, indent=2, sort_keys=True)
+    write_json(path, all_tags)
     print(f"Generated global all-tags.json with {len(all_tags)} tags total")
 
-def has_changes():
-    """Return True if there are untracked or modified files."""
-    result = subprocess.run(
-        ["git", "status", "--porcelain"],
-        cwd=TRACKING_WORKTREE_DIR,
-        stdout=subprocess.PIPE,
-        text=True
-    )
-    return bool(result.stdout.strip())
+def commit_snapshot():
+    """Stage and commit the snapshot, tolerating the no-change case."""
+    run(["git", "add", "."], capture=False)
+    # Exit code only, no parsing of localized git messages: 0 means the
+    # index matches HEAD and there is nothing to commit.
+    if subprocess.run(["git", "diff", "--cached", "--quiet"]).returncode == 0:
+        print("No changes to commit")
+        return
+    snapshot_msg = f"Snapshot {datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}"
+    run(["git", "commit", "-m", snapshot_msg], capture=False)
+
+def process_repo(repo_id, repo_path):
+    """Export one repo's refs and manifests, return its tags"""
+    print(f"\nProcessing repo: {repo_id}")
+
+    # Create the output directories once instead of per exported ref
+    repo_dir = os.path.join(REPOS_DIR, repo_id)
+    os.makedirs(os.path.join(repo_dir, "branches"), exist_ok=True)
+    os.makedirs(os.path.join(repo_dir, "tags"), exist_ok=True)
+
+    # Separate manifests for branches and tags
+    branches_manifest = {}
+    tags_manifest = {}
+    repo_tags = {}
+
+    branch_tips, tag_tips = collect_ref_tips(repo_path)
+
+    # One full walk decodes every commit subject once; per-ref exports then
+    # only need cheap hash-only rev-list walks plus dictionary lookups.
+    commit_metadata = collect_commit_metadata(repo_path)
+
+    # Each ref writes to its own file, so exports can run concurrently;
+    # manifests are filled in from the returned entries afterwards.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        branch_futures = [executor.submit(export_branch_commits, repo_path, repo_id, branch, tip, commit_metadata)
+                          for branch, tip in branch_tips.items()]
+        tag_futures = [executor.submit(export_tag_commit, repo_id, tag, tip, commit_metadata)
+                       for tag, tip in tag_tips.items()]
+        for future in branch_futures:
+            branch_name, filename = future.result()
+            branches_manifest[branch_name] = filename
+        for future in tag_futures:
+            tag_name, filename, commit_hash = future.result()
+            tags_manifest[tag_name] = filename
+            repo_tags[f"{repo_id}:{tag_name}"] = commit_hash
+
+    # Write manifests separately
+    generate_manifest(branches_manifest, repo_id, "branches-manifest.json")
+    generate_manifest(tags_manifest, repo_id, "tags-manifest.json")
+    return repo_tags
 
 def main():
     ensure_tracking_worktree()
     os.makedirs(REPOS_DIR, exist_ok=True)
     repos = read_tracked_repos()
     all_tags = {}
+    previous_all_tags = load_previous_all_tags()
 
-    for repo_id, clone_url in repos:
-        print(f"\nProcessing repo: {repo_id}")
-        repo_path = ensure_repo_cloned(repo_id, clone_url)
-
-        # Separate manifests for branches and tags
-        branches_manifest = {}
-        tags_manifest = {}
+    # Fetch phase: purely network-bound, so overlap all clones/fetches first
+    # instead of interleaving them with the export work. Repos whose remote
+    # refs have not moved since the last snapshot are not fetched at all.
+    fetch_workers = max(1, min(len(repos), 8))
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        fetch_futures = [executor.submit(prepare_repo, repo_id, clone_url) for repo_id, clone_url in repos]
+        prepared = {repo_id: future.result() for (repo_id, _), future in zip(repos, fetch_futures)}
 
-        # Branches
-        branches = run(["git", "for-each-ref", "--format=%(refname:short)", "refs/heads"], cwd=repo_path).splitlines()
-        for branch in branches:
-            export_branch_commits(repo_path, repo_id, branch, branches_manifest)
+    # Export phase: repos are independent and dominated by git subprocesses,
+    # so a thread pool keeps several repos in flight at once.
+    to_export = [(repo_id, path) for repo_id, (path, _) in prepared.items() if path is not None]
+    max_workers = max(1, min(len(to_export), os.cpu_count() or 4))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_repo, repo_id, path) for repo_id, path in to_export]
+        for future in futures:
+            all_tags.update(future.result())
 
-        # Tags
-        tags = run(["git", "for-each-ref", "--format=%(refname:short)", "refs/tags"], cwd=repo_path).splitlines()
-        for tag in tags:
-            export_tag_commit(repo_path, repo_id, tag, tags_manifest, all_tags)
-
-        # Write manifests separately
-        generate_manifest(branches_manifest, repo_id, "branches-manifest.json")
-        generate_manifest(tags_manifest, repo_id, "tags-manifest.json")
+    # Skipped repos keep their ref files from the previous snapshot; carry
+    # their entries in the global tag map over as well.
+    for repo_id, (path, _) in prepared.items():
+        if path is None:
+            prefix = repo_id + ":"
+            all_tags.update({k: v for k, v in previous_all_tags.items() if k.startswith(prefix)})
 
     # Write global tags manifest
     write_all_tags_manifest(all_tags)
 
+    # Remember the remote digests; they are committed with the snapshot
+    for repo_id, (_, digest) in prepared.items():
+        store_tips_digest(repo_id, digest)
+
     # Commit snapshot to tracking branch
     os.chdir(TRACKING_WORKTREE_DIR)
-    if has_changes():
-        run(["git", "add", "."], capture=False)
-        snapshot_msg = f"Snapshot {datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}"
-        run(["git", "commit", "-m", snapshot_msg], capture=False)
-    else:
-        print("No changes to commit")
+    commit_snapshot()
 
     # Clean up temporary clones
     shutil.rmtree(TMP_REPOS_DIR, ignore_errors=True)